@@ -1,17 +1,52 @@
+import hashlib
+import html
+import io
+import json
+import math
 import os
-import time
-import tempfile
-from typing import Optional
+import re
+import subprocess
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Optional
 from dataclasses import dataclass
 
 import assemblyai as aai
 import google.generativeai as genai
 import streamlit as st
+import tenacity
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from dotenv import load_dotenv
+from google.api_core.exceptions import ResourceExhausted
+
+try:
+    from pydub import AudioSegment
+    from pydub.silence import detect_silence
+except ImportError:  # chunked transcription is optional
+    AudioSegment = None
+    detect_silence = None
 
 
 GEMINI_MODEL_NAME = "gemini-2.5-flash"
 INSURANCE_STYLE_DEFAULT = "Claim Justification"
+GEMINI_MAX_ATTEMPTS = 3
+RESPONSE_CACHE_MAX_ENTRIES = 32
+QUOTA_EXCEEDED_MESSAGE = (
+    "⚠️ API quota exceeded. Please wait a few minutes and try again, or consider upgrading your API plan."
+)
+
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+# Recordings longer than the threshold are split on silence near every
+# TRANSCRIBE_CHUNK_TARGET_S and the chunks transcribed concurrently.
+TRANSCRIBE_CHUNK_THRESHOLD_S = 600
+TRANSCRIBE_CHUNK_TARGET_S = 180
+TRANSCRIBE_MAX_WORKERS = 4
+TRANSCRIBE_SAMPLE_RATE = 16000
+# Below this size an upload cannot exceed the threshold at 16 kbit/s or more,
+# so it is sent whole without being decoded.
+TRANSCRIBE_CHUNK_MIN_BYTES = TRANSCRIBE_CHUNK_THRESHOLD_S * 16_000 // 8
 
 
 @dataclass
@@ -23,45 +58,56 @@ class ClaimAnalysis:
     suggested_cpt_codes: list[tuple[str, str]]
 
 
-def _read_dotenv_value(dotenv_path: str, key: str) -> Optional[str]:
-    try:
-        with open(dotenv_path, "r", encoding="utf-8") as f:
-            for raw_line in f:
-                line = raw_line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                if "=" not in line:
-                    continue
-                k, v = line.split("=", 1)
-                k = k.strip().lstrip("\ufeff")
-                if k != key:
-                    continue
-                v = v.strip().strip("\"").strip("'")
-                return v or None
-    except OSError:
-        return None
-    return None
-
-
+def _required_object(**properties: dict) -> dict:
+    """OpenAPI object schema in which every property is required."""
+    return {"type": "object", "properties": properties, "required": list(properties)}
+
+
+_STRING_SCHEMA = {"type": "string"}
+
+# Gemini response schema for the single-call documentation bundle. Written as
+# a dict because the SDK drops "required" from TypedDict schemas. Gemini
+# writes the properties of an unordered schema alphabetically, so the step
+# prefixes make it write SOAP before the outputs derived from it.
+_BUNDLE_RESPONSE_SCHEMA = _required_object(
+    step1_soap=_STRING_SCHEMA,
+    step2_hp=_STRING_SCHEMA,
+    step3_insurance=_STRING_SCHEMA,
+    step4_claim_analysis=_required_object(
+        risk_level=_STRING_SCHEMA,
+        risk_explanation=_STRING_SCHEMA,
+        missing_elements={
+            "type": "array",
+            "items": _required_object(element=_STRING_SCHEMA, reason=_STRING_SCHEMA),
+        },
+        improvement_suggestions={"type": "array", "items": _STRING_SCHEMA},
+        suggested_cpt_codes={
+            "type": "array",
+            "items": _required_object(code=_STRING_SCHEMA, description=_STRING_SCHEMA),
+        },
+    ),
+)
+
+_BUNDLE_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": _BUNDLE_RESPONSE_SCHEMA,
+}
+
+
+# Streamlit re-executes this script on every rerun, so .env is read through
+# st.cache_resource to parse it once per server process.
+@st.cache_resource
 def _load_config() -> tuple[Optional[str], Optional[str]]:
     dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
-    load_dotenv(dotenv_path=dotenv_path, override=True)
-
-    assemblyai_key = os.getenv("ASSEMBLE_API_KEY")
-    if not assemblyai_key:
-        assemblyai_key = _read_dotenv_value(dotenv_path, "ASSEMBLE_API_KEY")
-        if assemblyai_key:
-            os.environ["ASSEMBLE_API_KEY"] = assemblyai_key
-
-    gemini_key = os.getenv("GEMINI_API_KEY")
-    if not gemini_key:
-        gemini_key = _read_dotenv_value(dotenv_path, "GEMINI_API_KEY")
-        if gemini_key:
-            os.environ["GEMINI_API_KEY"] = gemini_key
-
-    return assemblyai_key, gemini_key
+    load_dotenv(dotenv_path=dotenv_path, override=False)
+    return os.getenv("ASSEMBLE_API_KEY"), os.getenv("GEMINI_API_KEY")
 
 
+# genai.configure() rebuilds the Gemini client and credentials, so it runs
+# once per process (per key pair) rather than on every rerun. This relies on
+# all Gemini calls using the sync client: the SDK's global grpc.aio client is
+# bound to one event loop and would only be reset by calling configure again.
+@st.cache_resource
 def _configure_clients(assemblyai_key: Optional[str], gemini_key: Optional[str]) -> None:
     if assemblyai_key:
         aai.settings.api_key = assemblyai_key
@@ -69,159 +115,380 @@ def _configure_clients(assemblyai_key: Optional[str], gemini_key: Optional[str])
         genai.configure(api_key=gemini_key)
 
 
-def _transcribe_audio_bytes_with_diarization(audio_bytes: bytes, file_name: str) -> tuple[str, str]:
+def _decode_speech_pcm(audio: BinaryIO) -> "AudioSegment":
+    """Decode to 16 kHz mono 16-bit PCM inside ffmpeg.
+
+    pydub's from_file holds several full-rate copies of the decoded PCM before
+    it can be resampled; at speech rate an hour of audio is about 115 MB.
+    """
+    command = [
+        AudioSegment.converter, "-v", "error",
+        "-read_ahead_limit", "-1", "-i", "cache:pipe:0",
+        "-ac", "1", "-ar", str(TRANSCRIBE_SAMPLE_RATE), "-f", "s16le", "pipe:1",
+    ]
+    result = subprocess.run(command, input=audio.read(), capture_output=True, check=True)
+    return AudioSegment(data=result.stdout, sample_width=2, frame_rate=TRANSCRIBE_SAMPLE_RATE, channels=1)
+
+
+def _split_audio_on_silence(audio: BinaryIO, target_chunk_s: int = TRANSCRIBE_CHUNK_TARGET_S) -> list[BinaryIO]:
+    """Split long audio near every target_chunk_s at the nearest pause.
+
+    Returns [audio] unchanged when pydub/ffmpeg is unavailable, the upload is
+    smaller than TRANSCRIBE_CHUNK_MIN_BYTES, the file cannot be decoded, or it
+    is shorter than TRANSCRIBE_CHUNK_THRESHOLD_S.
+    """
+    if AudioSegment is None:
+        return [audio]
+    size = audio.seek(0, io.SEEK_END)
+    audio.seek(0)
+    if size < TRANSCRIBE_CHUNK_MIN_BYTES:
+        return [audio]
+    try:
+        segment = _decode_speech_pcm(audio)
+    except Exception:
+        audio.seek(0)
+        return [audio]
+    if len(segment) <= TRANSCRIBE_CHUNK_THRESHOLD_S * 1000:
+        audio.seek(0)
+        return [audio]
+
+    target_ms = target_chunk_s * 1000
+    window_ms = 30_000
+    silence_thresh = segment.dBFS - 16
+    cuts = [0]
+    while len(segment) - cuts[-1] > target_ms + window_ms:
+        target = cuts[-1] + target_ms
+        lo, hi = target - window_ms, target + window_ms
+        silences = detect_silence(segment[lo:hi], min_silence_len=700, silence_thresh=silence_thresh, seek_step=10)
+        if silences:
+            start, stop = min(silences, key=lambda s: abs(lo + (s[0] + s[1]) // 2 - target))
+            cuts.append(lo + (start + stop) // 2)
+        else:
+            cuts.append(target)
+    cuts.append(len(segment))
+
+    chunks: list[BinaryIO] = []
+    for begin, finish in zip(cuts, cuts[1:]):
+        buf = io.BytesIO()
+        segment[begin:finish].export(buf, format="flac")
+        buf.seek(0)
+        chunks.append(buf)
+    return chunks
+
+
+def _transcribe_chunk(
+    transcriber: aai.Transcriber, audio: BinaryIO, config: aai.TranscriptionConfig, label_prefix: str = ""
+) -> tuple[str, list[str]]:
+    transcript = transcriber.transcribe(audio, config=config)
+    if transcript.status == aai.TranscriptStatus.error:
+        raise RuntimeError(transcript.error or "Transcription failed")
+
+    plain = transcript.text or ""
+    diarized_lines = [
+        f"Speaker {label_prefix}{getattr(u, 'speaker', None)}: {u.text}"
+        for u in (getattr(transcript, "utterances", None) or ())
+        if getattr(u, "text", "")
+    ]
+    return plain, diarized_lines or ([plain] if plain else [])
+
+
+def _transcribe_audio_with_diarization(audio: BinaryIO) -> tuple[str, str]:
+    """Transcribe a file-like audio stream; the SDK uploads it without a temp file.
+
+    Long recordings are split on silence and the chunks transcribed in
+    parallel. AssemblyAI assigns speaker labels per chunk, so labels are
+    prefixed with the chunk number ("Speaker 2-A") rather than implying that
+    the same letter is the same person across chunk boundaries.
+    """
     if not aai.settings.api_key:
         raise RuntimeError("Missing required API key. Please configure required keys in the server environment.")
 
     transcriber = aai.Transcriber()
     config = aai.TranscriptionConfig(speaker_labels=True)
-    suffix = os.path.splitext(file_name)[1] or ".wav"
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        tmp.write(audio_bytes)
-        tmp_path = tmp.name
+    chunks = _split_audio_on_silence(audio)
+
+    if len(chunks) == 1:
+        results = [_transcribe_chunk(transcriber, chunks[0], config)]
+    else:
+        with ThreadPoolExecutor(max_workers=min(TRANSCRIBE_MAX_WORKERS, len(chunks))) as pool:
+            results = list(
+                pool.map(
+                    lambda n, chunk: _transcribe_chunk(transcriber, chunk, config, f"{n}-"),
+                    range(1, len(chunks) + 1),
+                    chunks,
+                )
+            )
 
-    try:
-        transcript = transcriber.transcribe(tmp_path, config=config)
-        if transcript.status == aai.TranscriptStatus.error:
-            raise RuntimeError(transcript.error or "Transcription failed")
-
-        plain = transcript.text or ""
-        diarized_lines: list[str] = []
-        if getattr(transcript, "utterances", None):
-            for u in transcript.utterances:
-                speaker = getattr(u, "speaker", None)
-                text = getattr(u, "text", "")
-                if text:
-                    diarized_lines.append(f"Speaker {speaker}: {text}")
-
-        diarized = "\n".join(diarized_lines) if diarized_lines else plain
-        return plain, diarized
-    finally:
-        try:
-            os.unlink(tmp_path)
-        except OSError:
-            pass
+    plain = " ".join(text for text, _ in results if text)
+    diarized = "\n".join(line for _, lines in results for line in lines)
+    return plain, diarized
+
+
+def _response_cache() -> dict[str, str]:
+    """Exact-match Gemini responses for this browser session, oldest first.
+
+    Lives in session state (seeded by _init_state) so patient text is dropped
+    with the session instead of being held for the life of the process.
+    """
+    return st.session_state["response_cache"]
+
+
+def _cache_response(key: str, text: str) -> None:
+    cache = _response_cache()
+    with _RESPONSE_CACHE_LOCK:
+        cache[key] = text
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache.pop(next(iter(cache)))
 
 
-def _gemini_generate_with_retry(prompt: str, model_name: str, max_retries: int = 3) -> str:
+@st.cache_resource(max_entries=4)
+def _get_model(model_name: str) -> genai.GenerativeModel:
+    # Requires genai.configure(), which _configure_clients runs before any stage.
+    return genai.GenerativeModel(model_name)
+
+
+def _response_cache_key(prompt: str, model_name: str, generation_config: Optional[dict] = None) -> str:
+    config = json.dumps(generation_config, sort_keys=True, default=repr) if generation_config else ""
+    return hashlib.blake2b("\0".join((model_name, config, prompt)).encode(), digest_size=16).hexdigest()
+
+
+def _warn_quota_retry(retry_state: tenacity.RetryCallState) -> None:
+    wait_time = retry_state.next_action.sleep if retry_state.next_action else 0
+    st.warning(
+        f"⏳ API quota reached. Retrying in {math.ceil(wait_time)} seconds... "
+        f"(Attempt {retry_state.attempt_number}/{GEMINI_MAX_ATTEMPTS})"
+    )
+
+
+# Exponential backoff on quota errors only, at the original 5 s / 10 s scale so
+# per-minute quotas can recover, plus up to 5 s of jitter so concurrent
+# sessions that hit the limit together do not retry in lockstep.
+_retry_on_quota = tenacity.retry(
+    retry=tenacity.retry_if_exception_type(ResourceExhausted),
+    wait=tenacity.wait_exponential(multiplier=5, max=60) + tenacity.wait_random(0, 5),
+    stop=tenacity.stop_after_attempt(GEMINI_MAX_ATTEMPTS),
+    before_sleep=_warn_quota_retry,
+    reraise=True,
+)
+
+
+@_retry_on_quota
+def _gemini_call(prompt: str, model_name: str, cancel: Optional[threading.Event] = None, **kwargs):
+    if cancel is not None and cancel.is_set():
+        raise CancelledError()
+    return _get_model(model_name).generate_content(prompt, **kwargs)
+
+
+def _gemini_generate_with_retry(
+    prompt: str,
+    model_name: str,
+    generation_config: Optional[dict] = None,
+    placeholder=None,
+    cancel: Optional[threading.Event] = None,
+) -> str:
+    """Generate a response; when a placeholder is given the response is streamed into it.
+
+    Once cancel is set, quota backoff wakes up, no further attempt is made,
+    streaming stops, and CancelledError is raised instead of returning.
+    """
     if not getattr(genai, "configure", None):
         raise RuntimeError("AI generation client not available")
-    
-    for attempt in range(max_retries):
-        try:
-            model = genai.GenerativeModel(model_name)
-            resp = model.generate_content(prompt)
-            if hasattr(resp, "text") and resp.text:
-                return resp.text
-            return ""
-        except Exception as e:
-            error_str = str(e).lower()
-            if "quota" in error_str or "429" in error_str or "rate limit" in error_str:
-                if attempt < max_retries - 1:
-                    wait_time = min(60, (2 ** attempt) * 5)
-                    st.warning(f"⏳ API quota reached. Retrying in {wait_time} seconds... (Attempt {attempt + 1}/{max_retries})")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    raise RuntimeError("⚠️ API quota exceeded. Please wait a few minutes and try again, or consider upgrading your API plan.") from e
-            else:
-                raise
-    return ""
-
 
-def _gemini_generate(prompt: str, model_name: str) -> str:
-    return _gemini_generate_with_retry(prompt, model_name)
+    cache = _response_cache()
+    key = _response_cache_key(prompt, model_name, generation_config)
+    if key in cache:
+        if placeholder is not None:
+            placeholder.markdown(cache[key])
+        return cache[key]
+    
+    call = _gemini_call if cancel is None else _gemini_call.retry_with(sleep=cancel.wait)
+    try:
+        resp = call(
+            prompt, model_name, cancel=cancel, generation_config=generation_config, stream=placeholder is not None
+        )
+    except ResourceExhausted as e:
+        raise RuntimeError(QUOTA_EXCEEDED_MESSAGE) from e
+    if placeholder is None:
+        text = resp.text if hasattr(resp, "text") and resp.text else ""
+    else:
+        text = ""
+        for chunk in resp:
+            if cancel is not None and cancel.is_set():
+                raise CancelledError()
+            if chunk.parts:
+                text += chunk.text
+                placeholder.markdown(text)
+    if text:
+        _cache_response(key, text)
+    return text
+
+
+def _gemini_generate(
+    prompt: str,
+    model_name: str,
+    generation_config: Optional[dict] = None,
+    placeholder=None,
+    cancel: Optional[threading.Event] = None,
+) -> str:
+    return _gemini_generate_with_retry(prompt, model_name, generation_config, placeholder, cancel)
+
+
+def _script_thread_pool(max_workers: int) -> ThreadPoolExecutor:
+    """Thread pool whose workers can write to the page and read session state.
+
+    Concurrent Gemini calls go through the sync client on threads rather than
+    generate_content_async: the SDK's grpc.aio client binds to the event loop
+    it was first used on, so a second asyncio.run() fails with "Event loop is
+    closed" once the client or model is reused across reruns.
+    """
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=add_script_run_ctx, initargs=(None, ctx))
+
+
+# Fixed instruction blocks, built once at import; the prompt builders only
+# append the per-call input.
+_CLINICAL_NOTE_PREFIX = (
+    "You are a medical documentation assistant. "
+    "Convert the following doctor-patient conversation into a structured clinical note. "
+    "Do not invent facts. If something is missing, write 'Not documented'. "
+    "Do not change clinical decisions; only document what is present.\n\n"
+    "If NOTE FORMAT is SOAP, output exactly these headers: Subjective, Objective, Assessment, Plan.\n"
+    "If NOTE FORMAT is H&P, output exactly these headers: Chief Complaint, HPI, PMH, Medications, Allergies, ROS, "
+    "Physical Exam, Assessment, Plan.\n\n"
+)
 
 
 def _build_clinical_note_prompt(conversation_text: str, note_style: str) -> str:
-    return (
-        "You are a medical documentation assistant. "
-        "Convert the following doctor-patient conversation into a structured clinical note. "
-        "Do not invent facts. If something is missing, write 'Not documented'. "
-        "Do not change clinical decisions; only document what is present.\n\n"
-        f"NOTE FORMAT: {note_style}\n"
-        "If NOTE FORMAT is SOAP, output exactly these headers: Subjective, Objective, Assessment, Plan.\n"
-        "If NOTE FORMAT is H&P, output exactly these headers: Chief Complaint, HPI, PMH, Medications, Allergies, ROS, "
-        "Physical Exam, Assessment, Plan.\n\n"
+    return _CLINICAL_NOTE_PREFIX + (
+        f"NOTE FORMAT: {note_style}\n\n"
         "CONVERSATION:\n"
         f"{conversation_text}\n"
     )
 
 
+_INSURANCE_PREFIX = (
+    "You are an insurance documentation assistant. "
+    "Rewrite the provided clinical note into insurer-friendly documentation. "
+    "Do not add new diagnoses, findings, vitals, exam elements, test results, or treatments. "
+    "Do not alter clinical decisions. "
+    "Your job is to clarify medical necessity using only what is present.\n\n"
+    "Output must be concise, structured, and ready to support a claim.\n"
+    "Include the following sections (even if 'Not documented'):\n"
+    "1) Clinical Summary\n"
+    "2) Symptoms/Functional Impact\n"
+    "3) Relevant History\n"
+    "4) Exam/Objective Findings\n"
+    "5) Assessment (Problem List)\n"
+    "6) Plan and Medical Necessity Rationale\n"
+    "7) Risk/Complexity (brief)\n\n"
+)
+
+
 def _build_insurance_prompt(clinical_note: str, insurance_style: str) -> str:
-    return (
-        "You are an insurance documentation assistant. "
-        "Rewrite the provided clinical note into insurer-friendly documentation. "
-        "Do not add new diagnoses, findings, vitals, exam elements, test results, or treatments. "
-        "Do not alter clinical decisions. "
-        "Your job is to clarify medical necessity using only what is present.\n\n"
-        f"OUTPUT STYLE: {insurance_style}\n"
-        "Output must be concise, structured, and ready to support a claim.\n"
-        "Include the following sections (even if 'Not documented'):\n"
-        "1) Clinical Summary\n"
-        "2) Symptoms/Functional Impact\n"
-        "3) Relevant History\n"
-        "4) Exam/Objective Findings\n"
-        "5) Assessment (Problem List)\n"
-        "6) Plan and Medical Necessity Rationale\n"
-        "7) Risk/Complexity (brief)\n\n"
+    return _INSURANCE_PREFIX + (
+        f"OUTPUT STYLE: {insurance_style}\n\n"
         "CLINICAL NOTE:\n"
         f"{clinical_note}\n"
     )
 
 
-def _build_claim_analysis_prompt(insurance_note: str, clinical_note: str) -> str:
-    return (
-        "You are an insurance claim review assistant. Analyze the provided documentation for claim rejection risk.\n\n"
-        "CRITICAL RULES:\n"
-        "- Base your analysis ONLY on what is documented\n"
-        "- Do NOT invent medical facts\n"
-        "- Do NOT suggest adding false information\n"
-        "- Flag what is missing, not what should be fabricated\n\n"
-        "ANALYZE FOR:\n"
-        "1) RISK LEVEL (Low/Medium/High) based on:\n"
-        "   - Presence of objective findings\n"
-        "   - Severity documentation\n"
-        "   - Medical necessity clarity\n"
-        "   - Consistency between symptoms and plan\n\n"
-        "2) MISSING ELEMENTS that insurers commonly require:\n"
-        "   - Objective exam findings\n"
-        "   - Severity indicators (duration, frequency, impact)\n"
-        "   - Failed conservative treatments\n"
-        "   - Functional impact on daily activities\n"
-        "   - Baseline measurements or vitals\n"
-        "   - Prior authorization elements\n\n"
-        "3) IMPROVEMENT SUGGESTIONS:\n"
-        "   - Indicate what TYPE of information is missing\n"
-        "   - Suggest WHERE additional documentation would help\n"
-        "   - Do NOT provide specific medical values or findings\n\n"
-        "4) CPT CODE RECOMMENDATIONS:\n"
-        "   - Suggest appropriate E/M CPT codes based on documented complexity\n"
-        "   - Consider: history, exam, medical decision making\n"
-        "   - Common codes: 99202-99205 (new patient), 99211-99215 (established)\n"
-        "   - Explain why each code fits the documentation level\n\n"
-        "OUTPUT FORMAT (use this exact structure):\n"
-        "RISK_LEVEL: [Low Risk|Medium Risk|High Risk]\n"
-        "RISK_EXPLANATION: [2-3 sentences explaining the risk assessment]\n\n"
-        "MISSING_ELEMENTS:\n"
-        "- [Element name]: [Why it matters for insurance]\n"
-        "- [Element name]: [Why it matters for insurance]\n\n"
-        "IMPROVEMENT_SUGGESTIONS:\n"
-        "- [Suggestion]\n"
-        "- [Suggestion]\n\n"
-        "CPT_CODES:\n"
-        "- [Code]: [Description and why it fits]\n"
-        "- [Code]: [Description and why it fits]\n\n"
-        "INSURANCE DOCUMENTATION:\n"
-        f"{insurance_note}\n\n"
+_CLAIM_ANALYSIS_RULES = (
+    "You are an insurance claim review assistant. Analyze the provided documentation for claim rejection risk.\n\n"
+    "CRITICAL RULES:\n"
+    "- Base your analysis ONLY on what is documented\n"
+    "- Do NOT invent medical facts\n"
+    "- Do NOT suggest adding false information\n"
+    "- Flag what is missing, not what should be fabricated\n\n"
+    "ANALYZE FOR:\n"
+    "1) RISK LEVEL (Low/Medium/High) based on:\n"
+    "   - Presence of objective findings\n"
+    "   - Severity documentation\n"
+    "   - Medical necessity clarity\n"
+    "   - Consistency between symptoms and plan\n\n"
+    "2) MISSING ELEMENTS that insurers commonly require:\n"
+    "   - Objective exam findings\n"
+    "   - Severity indicators (duration, frequency, impact)\n"
+    "   - Failed conservative treatments\n"
+    "   - Functional impact on daily activities\n"
+    "   - Baseline measurements or vitals\n"
+    "   - Prior authorization elements\n\n"
+    "3) IMPROVEMENT SUGGESTIONS:\n"
+    "   - Indicate what TYPE of information is missing\n"
+    "   - Suggest WHERE additional documentation would help\n"
+    "   - Do NOT provide specific medical values or findings\n\n"
+    "4) CPT CODE RECOMMENDATIONS:\n"
+    "   - Suggest appropriate E/M CPT codes based on documented complexity\n"
+    "   - Consider: history, exam, medical decision making\n"
+    "   - Common codes: 99202-99205 (new patient), 99211-99215 (established)\n"
+    "   - Explain why each code fits the documentation level\n\n"
+)
+_CLAIM_ANALYSIS_PREFIX = _CLAIM_ANALYSIS_RULES + (
+    "OUTPUT FORMAT (use this exact structure):\n"
+    "RISK_LEVEL: [Low Risk|Medium Risk|High Risk]\n"
+    "RISK_EXPLANATION: [2-3 sentences explaining the risk assessment]\n\n"
+    "MISSING_ELEMENTS:\n"
+    "- [Element name]: [Why it matters for insurance]\n"
+    "- [Element name]: [Why it matters for insurance]\n\n"
+    "IMPROVEMENT_SUGGESTIONS:\n"
+    "- [Suggestion]\n"
+    "- [Suggestion]\n\n"
+    "CPT_CODES:\n"
+    "- [Code]: [Description and why it fits]\n"
+    "- [Code]: [Description and why it fits]\n\n"
+)
+
+
+def _build_claim_analysis_from_soap_prompt(soap_note: str) -> str:
+    # Risk, missing elements and CPT codes depend only on clinical content, so
+    # the review reads the SOAP note and can run alongside insurance rewriting.
+    return _CLAIM_ANALYSIS_PREFIX + (
         "CLINICAL NOTE:\n"
-        f"{clinical_note}\n"
+        f"{soap_note}\n"
+    )
+
+
+# Single-call variant: all four documents as one JSON object, reusing the
+# per-document instruction blocks above.
+_DOCUMENTATION_BUNDLE_PREFIX = (
+    "You are a medical and insurance documentation assistant. "
+    "From the doctor-patient conversation below, produce four outputs and return them as one JSON object:\n"
+    "- step1_soap: a clinical note with NOTE FORMAT SOAP, following the CLINICAL NOTE RULES\n"
+    "- step2_hp: a clinical note with NOTE FORMAT H&P, following the CLINICAL NOTE RULES\n"
+    "- step3_insurance: the step1_soap note rewritten following the INSURANCE DOCUMENTATION RULES\n"
+    "- step4_claim_analysis: a review of the step3_insurance and step1_soap outputs following the "
+    "CLAIM REVIEW RULES; "
+    "risk_level must be exactly one of Low Risk, Medium Risk, High Risk\n\n"
+    "CLINICAL NOTE RULES:\n" + _CLINICAL_NOTE_PREFIX
+    + "INSURANCE DOCUMENTATION RULES:\n" + _INSURANCE_PREFIX
+    + "CLAIM REVIEW RULES:\n" + _CLAIM_ANALYSIS_RULES
+)
+
+
+def _build_documentation_bundle_prompt(conversation_text: str, insurance_style: str) -> str:
+    return _DOCUMENTATION_BUNDLE_PREFIX + (
+        f"OUTPUT STYLE: {insurance_style}\n\n"
+        "CONVERSATION:\n"
+        f"{conversation_text}\n"
     )
 
 
+_SECTION_RE = re.compile(
+    r"^[ \t]*(RISK_LEVEL|RISK_EXPLANATION|MISSING_ELEMENTS|IMPROVEMENT_SUGGESTIONS|CPT_CODES"
+    r"|INSURANCE DOCUMENTATION|CLINICAL NOTE):[ \t]*(.*?)[ \t\r]*$",
+    re.M,
+)
+_BULLET_RE = re.compile(r"^[ \t]*-[ \t]*(.*?)[ \t\r]*$", re.M)
+# Bullet-list headers and the section each one opens
+_LIST_SECTIONS = {
+    "MISSING_ELEMENTS": "missing",
+    "IMPROVEMENT_SUGGESTIONS": "suggestions",
+    "CPT_CODES": "cpt",
+}
+# Echoed input after the analysis; parsing stops at the first of these
+_STOP_HEADERS = ("INSURANCE DOCUMENTATION", "CLINICAL NOTE")
+
+
 def _parse_claim_analysis(analysis_text: str) -> ClaimAnalysis:
-    lines = analysis_text.strip().split("\n")
-    
     risk_level = "Medium Risk"
     risk_explanation = ""
     missing_elements = []
@@ -229,34 +496,32 @@ def _parse_claim_analysis(analysis_text: str) -> ClaimAnalysis:
     suggested_cpt_codes = []
     
     current_section = None
+    headers = list(_SECTION_RE.finditer(analysis_text))
     
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-            
-        if line.startswith("RISK_LEVEL:"):
-            risk_level = line.replace("RISK_LEVEL:", "").strip()
-        elif line.startswith("RISK_EXPLANATION:"):
-            risk_explanation = line.replace("RISK_EXPLANATION:", "").strip()
-        elif line.startswith("MISSING_ELEMENTS:"):
-            current_section = "missing"
-        elif line.startswith("IMPROVEMENT_SUGGESTIONS:"):
-            current_section = "suggestions"
-        elif line.startswith("CPT_CODES:"):
-            current_section = "cpt"
-        elif line.startswith("INSURANCE DOCUMENTATION:") or line.startswith("CLINICAL NOTE:"):
+    for i, match in enumerate(headers):
+        header, value = match.groups()
+        if header in _STOP_HEADERS:
             break
-        elif line.startswith("-"):
-            content = line[1:].strip()
-            if current_section == "missing" and ":" in content:
-                parts = content.split(":", 1)
-                missing_elements.append((parts[0].strip(), parts[1].strip()))
-            elif current_section == "suggestions":
-                improvement_suggestions.append(content)
-            elif current_section == "cpt" and ":" in content:
-                parts = content.split(":", 1)
-                suggested_cpt_codes.append((parts[0].strip(), parts[1].strip()))
+        if header == "RISK_LEVEL":
+            risk_level = value
+        elif header == "RISK_EXPLANATION":
+            risk_explanation = value
+        else:
+            current_section = _LIST_SECTIONS[header]
+        
+        if current_section is None:
+            continue
+        body_end = headers[i + 1].start() if i + 1 < len(headers) else len(analysis_text)
+        bullets = _BULLET_RE.findall(analysis_text, match.end(), body_end)
+        if current_section == "suggestions":
+            improvement_suggestions.extend(bullets)
+            continue
+        # "missing" and "cpt" bullets are "<name>: <detail>" pairs
+        pairs = missing_elements if current_section == "missing" else suggested_cpt_codes
+        for content in bullets:
+            head, sep, tail = content.partition(":")
+            if sep:
+                pairs.append((head.strip(), tail.strip()))
     
     return ClaimAnalysis(
         risk_level=risk_level,
@@ -267,6 +532,94 @@ def _parse_claim_analysis(analysis_text: str) -> ClaimAnalysis:
     )
 
 
+def _parse_documentation_bundle(bundle_text: str) -> tuple[str, str, str, ClaimAnalysis]:
+    try:
+        data = json.loads(bundle_text)
+        analysis = data["step4_claim_analysis"]
+        claim_analysis = ClaimAnalysis(
+            risk_level=analysis.get("risk_level") or "Medium Risk",
+            risk_explanation=analysis.get("risk_explanation", ""),
+            missing_elements=[(m["element"], m["reason"]) for m in analysis.get("missing_elements", [])],
+            improvement_suggestions=list(analysis.get("improvement_suggestions", [])),
+            suggested_cpt_codes=[(c["code"], c["description"]) for c in analysis.get("suggested_cpt_codes", [])],
+        )
+        soap, hp, insurance = data["step1_soap"], data["step2_hp"], data["step3_insurance"]
+        return soap.strip(), hp.strip(), insurance.strip(), claim_analysis
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError("Malformed documentation bundle") from e
+
+
+def _gemini_generate_documentation_bundle(
+    conversation_text: str, insurance_style: str, model_name: str
+) -> tuple[str, str, str, ClaimAnalysis]:
+    """Generate SOAP, H&P, insurance note and claim analysis in one JSON call.
+
+    Raises ValueError when the response is not valid bundle JSON.
+    """
+    prompt = _build_documentation_bundle_prompt(conversation_text, insurance_style)
+    bundle_text = _gemini_generate(prompt, model_name, generation_config=_BUNDLE_GENERATION_CONFIG)
+    try:
+        return _parse_documentation_bundle(bundle_text)
+    except ValueError:
+        # Drop the bad response so a retry on this transcript asks Gemini
+        # again instead of being pinned to the per-document fallback.
+        _response_cache().pop(_response_cache_key(prompt, model_name, _BUNDLE_GENERATION_CONFIG), None)
+        raise
+
+
+def _generate_documentation_stages(
+    conversation_text: str, insurance_style: str, model_name: str, stream: bool = False
+) -> tuple[str, str, str, ClaimAnalysis]:
+    """Run the per-document prompts as a dependency graph.
+
+    Insurance and claim analysis each only depend on SOAP, and nothing reads
+    H&P, so H&P runs alongside SOAP -> (insurance || claim analysis). With
+    stream=True, partial output is written into the current container.
+    """
+    placeholders = {}
+    if stream:
+        col_soap, col_hp = st.columns(2)
+        with col_soap:
+            st.markdown("**🩺 SOAP**")
+            placeholders["soap"] = st.empty()
+        with col_hp:
+            st.markdown("**📋 H&P**")
+            placeholders["hp"] = st.empty()
+        st.markdown("**💼 Insurance**")
+        placeholders["insurance"] = st.empty()
+
+    soap_prompt = _build_clinical_note_prompt(conversation_text, "SOAP")
+    hp_prompt = _build_clinical_note_prompt(conversation_text, "H&P")
+    # Futures re-raise the stage's own exception, so callers can show str(e)
+    # as-is. On failure, siblings still in flight are cancelled and joined
+    # before returning: they make no further attempts or page writes, so no
+    # worker outlives this script run.
+    pool = _script_thread_pool(max_workers=2)
+    cancel = threading.Event()
+    try:
+        hp_future = pool.submit(
+            _gemini_generate, hp_prompt, model_name, placeholder=placeholders.get("hp"), cancel=cancel
+        )
+        soap_note = _gemini_generate(soap_prompt, model_name, placeholder=placeholders.get("soap")).strip()
+
+        insurance_prompt = _build_insurance_prompt(soap_note, insurance_style)
+        insurance_future = pool.submit(
+            _gemini_generate, insurance_prompt, model_name, placeholder=placeholders.get("insurance"), cancel=cancel
+        )
+        analysis_prompt = _build_claim_analysis_from_soap_prompt(soap_note)
+        analysis_text = _gemini_generate(analysis_prompt, model_name).strip()
+
+        insurance_note = insurance_future.result().strip()
+        hp_note = hp_future.result().strip()
+    except BaseException:
+        cancel.set()
+        raise
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    return soap_note, hp_note, insurance_note, _parse_claim_analysis(analysis_text)
+
+
 def _init_state() -> None:
     defaults = {
         "transcript_text": "",
@@ -278,6 +631,7 @@ def _init_state() -> None:
         "fix_mode": False,
         "additional_info": "",
         "current_step": 0,
+        "response_cache": {},
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -352,6 +706,24 @@ def _render_progress_card():
     st.markdown("</div>", unsafe_allow_html=True)
 
 
+@st.cache_resource
+def _load_css() -> str:
+    return (Path(__file__).parent / "static" / "style.css").read_text(encoding="utf-8")
+
+
+def _render_document(label: str, text: str) -> None:
+    """Render generated text in a fixed-height scrollable box that wraps lines.
+
+    Not a text_area: every widget holds a second copy of the document in
+    session state and posts its value back to the server on each interaction.
+    The text is escaped and kept on one HTML line so markdown never parses it.
+    """
+    st.caption(label)
+    with st.container(height=400, border=True):
+        body = html.escape(text).replace("\n", "<br>")
+        st.markdown(f'<div class="vs-document">{body}</div>', unsafe_allow_html=True)
+
+
 def main() -> None:
     st.set_page_config(
         page_title="VarmaScribe Insurance", 
@@ -362,69 +734,9 @@ def main() -> None:
 
     assemblyai_key, gemini_key = _load_config()
 
-    st.markdown(
-        """
-<style>
-    /* Modern color scheme */
-    :root {
-        --primary: #6366f1;
-        --success: #10b981;
-        --warning: #f59e0b;
-        --danger: #ef4444;
-    }
-    
-    /* Hero section */
-    .vs-hero {
-        padding: 24px;
-        border-radius: 16px;
-        background: linear-gradient(135deg, rgba(99, 102, 241, 0.1), rgba(16, 185, 129, 0.08));
-        border: 1px solid rgba(99, 102, 241, 0.2);
-        margin-bottom: 24px;
-    }
-    .vs-title { 
-        font-size: 36px; 
-        font-weight: 800; 
-        margin: 0 0 8px 0;
-        background: linear-gradient(135deg, #6366f1, #10b981);
-        -webkit-background-clip: text;
-        -webkit-text-fill-color: transparent;
-    }
-    .vs-subtitle { 
-        font-size: 16px; 
-        color: rgba(49, 51, 63, 0.75); 
-        margin: 0; 
-    }
-    
-    /* Card styling */
-    .vs-card {
-        border: 1px solid rgba(0, 0, 0, 0.1);
-        border-radius: 12px;
-        padding: 20px;
-        background: white;
-        box-shadow: 0 1px 3px rgba(0, 0, 0, 0.05);
-    }
-    
-    /* Risk badge styling */
-    .risk-badge {
-        display: inline-block;
-        padding: 8px 16px;
-        border-radius: 20px;
-        font-weight: 700;
-        font-size: 14px;
-    }
-    .risk-low { background: #d1fae5; color: #065f46; }
-    .risk-medium { background: #fef3c7; color: #92400e; }
-    .risk-high { background: #fee2e2; color: #991b1b; }
-    
-    /* Responsive design */
-    @media (max-width: 768px) {
-        .vs-title { font-size: 28px; }
-        .vs-card { padding: 16px; }
-    }
-</style>
-        """,
-        unsafe_allow_html=True,
-    )
+    # Streamlit drops elements that are not re-emitted, so the <style> tag is
+    # written every run; only reading the stylesheet is cached.
+    st.markdown(f"<style>{_load_css()}</style>", unsafe_allow_html=True)
 
     # Hero header
     st.markdown(
@@ -492,80 +804,50 @@ def main() -> None:
         elif not assemblyai_key or not gemini_key:
             st.error("⚠️ Missing API keys. Please configure in .env file.")
         else:
-            try:
-                # Step 1: Transcribe
-                st.session_state.current_step = 0
-                with st.spinner("🎤 Transcribing audio with speaker diarization..."):
-                    plain, diarized = _transcribe_audio_bytes_with_diarization(
-                        audio_file.getvalue(), audio_file.name
-                    )
+            # All stages run in this one script execution; a single rerun at
+            # the end refreshes the progress card and results section.
+            pipeline_done = False
+            with st.status("🚀 Generating documentation...", expanded=True) as status:
+                try:
+                    # Step 1: Transcribe
+                    st.session_state.current_step = 0
+                    st.write("🎤 Transcribing audio with speaker diarization...")
+                    # UploadedFile is already an in-memory stream; hand it over as-is.
+                    audio_file.seek(0)
+                    plain, diarized = _transcribe_audio_with_diarization(audio_file)
                     st.session_state.transcript_text = plain
                     st.session_state.diarized_transcript_text = diarized
-                st.success("✅ Transcription complete")
+                    st.write("✅ Transcription complete")
+
+                    # Steps 2-5: one combined call, per-document calls as fallback.
+                    # The combined JSON response is not streamed; partial output
+                    # only appears on the fallback path.
+                    st.session_state.current_step = 1
+                    st.write("📝 Generating clinical notes, insurance documentation and claim review...")
+                    try:
+                        documents = _gemini_generate_documentation_bundle(
+                            diarized, insurance_style, GEMINI_MODEL_NAME
+                        )
+                    except ValueError:
+                        st.write("⚠️ Combined response could not be parsed; generating each document separately...")
+                        documents = _generate_documentation_stages(
+                            diarized, insurance_style, GEMINI_MODEL_NAME, stream=True
+                        )
+                    soap_note, hp_note, insurance_note, claim_analysis = documents
+                    st.session_state.soap_note = soap_note
+                    st.session_state.hp_note = hp_note
+                    st.session_state.insurance_note = insurance_note
+                    st.session_state.claim_analysis = claim_analysis
+                    st.session_state.current_step = 5
+                    status.update(label="✅ Claim analysis complete!", state="complete", expanded=False)
+                    pipeline_done = True
+                except Exception as e:
+                    status.update(label="❌ Pipeline failed", state="error", expanded=True)
+                    st.error(f"❌ Error: {str(e)}")
+
+            if pipeline_done:
                 st.rerun()
 
-            except Exception as e:
-                st.error(f"❌ Error: {str(e)}")
-                st.session_state.current_step = 0
-
-    # Continue pipeline if transcript exists but other steps incomplete
-    if st.session_state.transcript_text and not st.session_state.soap_note:
-        try:
-            st.session_state.current_step = 1
-            with st.spinner("📝 Generating SOAP note..."):
-                soap_prompt = _build_clinical_note_prompt(
-                    st.session_state.diarized_transcript_text, "SOAP"
-                )
-                st.session_state.soap_note = _gemini_generate(soap_prompt, GEMINI_MODEL_NAME).strip()
-            st.success("✅ SOAP note generated")
-            st.rerun()
-        except Exception as e:
-            st.error(f"❌ Error generating SOAP note: {str(e)}")
-
-    if st.session_state.soap_note and not st.session_state.hp_note:
-        try:
-            st.session_state.current_step = 2
-            with st.spinner("📋 Generating H&P note..."):
-                hp_prompt = _build_clinical_note_prompt(
-                    st.session_state.diarized_transcript_text, "H&P"
-                )
-                st.session_state.hp_note = _gemini_generate(hp_prompt, GEMINI_MODEL_NAME).strip()
-            st.success("✅ H&P note generated")
-            st.rerun()
-        except Exception as e:
-            st.error(f"❌ Error generating H&P note: {str(e)}")
-
-    if st.session_state.hp_note and not st.session_state.insurance_note:
-        try:
-            st.session_state.current_step = 3
-            with st.spinner("💼 Generating insurance documentation..."):
-                insurance_prompt = _build_insurance_prompt(
-                    st.session_state.soap_note, insurance_style
-                )
-                st.session_state.insurance_note = _gemini_generate(
-                    insurance_prompt, GEMINI_MODEL_NAME
-                ).strip()
-            st.success("✅ Insurance note generated")
-            st.rerun()
-        except Exception as e:
-            st.error(f"❌ Error generating insurance note: {str(e)}")
-
-    if st.session_state.insurance_note and not st.session_state.claim_analysis:
-        try:
-            st.session_state.current_step = 4
-            with st.spinner("🔍 Analyzing claim readiness..."):
-                analysis_prompt = _build_claim_analysis_prompt(
-                    st.session_state.insurance_note,
-                    st.session_state.soap_note
-                )
-                analysis_text = _gemini_generate(analysis_prompt, GEMINI_MODEL_NAME).strip()
-                st.session_state.claim_analysis = _parse_claim_analysis(analysis_text)
-            st.success("✅ Claim analysis complete!")
-            st.session_state.current_step = 5
-            st.rerun()
-        except Exception as e:
-            st.error(f"❌ Error analyzing claim: {str(e)}")
-
     # Display results
     if st.session_state.claim_analysis or st.session_state.insurance_note:
         st.divider()
@@ -642,20 +924,13 @@ def main() -> None:
                                 try:
                                     enhanced = st.session_state.diarized_transcript_text + f"\n\nADDITIONAL INFO:\n{additional_info}"
                                     
-                                    soap_prompt = _build_clinical_note_prompt(enhanced, "SOAP")
-                                    st.session_state.soap_note = _gemini_generate(soap_prompt, GEMINI_MODEL_NAME).strip()
-                                    
-                                    hp_prompt = _build_clinical_note_prompt(enhanced, "H&P")
-                                    st.session_state.hp_note = _gemini_generate(hp_prompt, GEMINI_MODEL_NAME).strip()
-                                    
-                                    ins_prompt = _build_insurance_prompt(st.session_state.soap_note, insurance_style)
-                                    st.session_state.insurance_note = _gemini_generate(ins_prompt, GEMINI_MODEL_NAME).strip()
-                                    
-                                    analysis_prompt = _build_claim_analysis_prompt(
-                                        st.session_state.insurance_note, st.session_state.soap_note
+                                    soap_note, hp_note, insurance_note, claim_analysis = _generate_documentation_stages(
+                                        enhanced, insurance_style, GEMINI_MODEL_NAME
                                     )
-                                    analysis_text = _gemini_generate(analysis_prompt, GEMINI_MODEL_NAME).strip()
-                                    st.session_state.claim_analysis = _parse_claim_analysis(analysis_text)
+                                    st.session_state.soap_note = soap_note
+                                    st.session_state.hp_note = hp_note
+                                    st.session_state.insurance_note = insurance_note
+                                    st.session_state.claim_analysis = claim_analysis
                                     
                                     st.session_state.fix_mode = False
                                     st.success("✅ Documentation updated!")
@@ -688,33 +963,23 @@ def main() -> None:
 
         with tabs[0]:
             if st.session_state.transcript_text:
-                st.text_area("Plain Transcript", st.session_state.transcript_text, height=400, key="t1")
+                _render_document("Plain Transcript", st.session_state.transcript_text)
 
         with tabs[1]:
             if st.session_state.diarized_transcript_text:
-                st.text_area("Diarized Transcript", st.session_state.diarized_transcript_text, height=400, key="t2")
+                _render_document("Diarized Transcript", st.session_state.diarized_transcript_text)
 
         with tabs[2]:
             if st.session_state.soap_note:
-                st.text_area("SOAP Note", st.session_state.soap_note, height=400, key="t3")
+                _render_document("SOAP Note", st.session_state.soap_note)
 
         with tabs[3]:
             if st.session_state.hp_note:
-                st.text_area(
-                    "H&P Note",
-                    st.session_state.hp_note,
-                    height=400,
-                    key="t4"
-                )
+                _render_document("H&P Note", st.session_state.hp_note)
 
         with tabs[4]:
             if st.session_state.insurance_note:
-                st.text_area(
-                    "Insurance Documentation",
-                    st.session_state.insurance_note,
-                    height=400,
-                    key="t5"
-                )
+                _render_document("Insurance Documentation", st.session_state.insurance_note)
 
                 st.download_button(
                     label="📥 Download Insurance Note",